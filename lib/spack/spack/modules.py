@@ -44,7 +44,6 @@ import itertools
 import os
 import os.path
 import re
-import string
 import textwrap
 
 import llnl.util.tty as tty
@@ -61,9 +60,40 @@ __all__ = ['EnvModule', 'Dotkit', 'TclModule']
 # Registry of all types of modules.  Entries created by EnvModule's metaclass
 module_types = {}
 
+# Cache of module file generators, keyed on (module type, spec hash)
+_generators_registry = {}
+
 CONFIGURATION = spack.config.get_config('modules')
 
 
+# Matches replacement fields like '{name}' in a format string
+_has_format_fields = re.compile(r'\{[^}]*\}').search
+
+
+def _mismatching_path_part(lhs, rhs):
+    """
+    Walks two '/' separated paths side by side, stopping at the end of the
+    shorter one.
+
+    Args:
+        lhs: first path
+        rhs: second path
+
+    Returns:
+        the first pair of parts that differ, None if there is no such pair
+    """
+    lstart = rstart = 0
+    while True:
+        lend, rend = lhs.find('/', lstart), rhs.find('/', rstart)
+        lpart = lhs[lstart:] if lend == -1 else lhs[lstart:lend]
+        rpart = rhs[rstart:] if rend == -1 else rhs[rstart:rend]
+        if lpart != rpart:
+            return lpart, rpart
+        if lend == -1 or rend == -1:
+            return None
+        lstart, rstart = lend + 1, rend + 1
+
+
 def print_help():
     """
     For use by commands to tell user how to activate shell support.
@@ -216,6 +246,26 @@ def parse_config_options(module_generator):
     return module_file_actions, env
 
 
+def make_generator(module_type, spec):
+    """
+    Returns a module file generator of the given type for a concrete spec.
+    Generators are cached per spec, as the same dependencies are visited
+    over and over when writing module files for a whole DAG.
+
+    Args:
+        module_type: type of module file objects
+        spec: concrete spec instance
+
+    Returns:
+        instance of module_type for spec
+    """
+    key = (module_type, spec.dag_hash())
+    try:
+        return _generators_registry[key]
+    except KeyError:
+        return _generators_registry.setdefault(key, module_type(spec))
+
+
 def filter_blacklisted(specs, module_name):
     """
     Given a sequence of specs, filters the ones that are blacklisted in the
@@ -229,7 +279,7 @@ def filter_blacklisted(specs, module_name):
         non blacklisted specs
     """
     for x in specs:
-        if module_types[module_name](x).blacklisted:
+        if make_generator(module_types[module_name], x).blacklisted:
             tty.debug('\tFILTER : %s' % x)
             continue
         yield x
@@ -444,14 +494,14 @@ class EnvModule(object):
 
     def autoload(self, spec):
         if not isinstance(spec, str):
-            m = type(self)(spec)
+            m = make_generator(type(self), spec)
             module_file = m.use_name
         else:
             module_file = spec
         return self.autoload_format.format(module_file=module_file)
 
     def prerequisite(self, spec):
-        m = type(self)(spec)
+        m = make_generator(type(self), spec)
         return self.prerequisite_format.format(module_file=m.use_name)
 
     def process_environment_command(self, env):
@@ -547,6 +597,18 @@ class TclModule(EnvModule):
 
     prerequisite_format = 'prereq {module_file}\n'
 
+    header_format = ('#%Module1.0\n'
+                     '## Module file created by spack (https://github.com/LLNL/spack) on {timestamp}\n'  # NOQA: ignore=E501
+                     '##\n'
+                     '## {short_spec}\n'
+                     '##\n')
+
+    conflict_error_format = (
+        'conflict scheme does not match naming scheme [{spec}]\n\n'
+        'naming scheme   : "{nformat}"\n'
+        'conflict scheme : "{cformat}"\n\n'
+        '** You may want to check your `modules.yaml` configuration file **\n')  # NOQA: ignore=E501
+
     default_naming_format = '{name}-{version}-{compiler.name}-{compiler.version}'  # NOQA: ignore=E501
 
     @property
@@ -557,11 +619,8 @@ class TclModule(EnvModule):
     def header(self):
         timestamp = datetime.datetime.now()
         # TCL Modulefile header
-        header = '#%Module1.0\n'
-        header += '## Module file created by spack (https://github.com/LLNL/spack) on %s\n' % timestamp  # NOQA: ignore=E501
-        header += '##\n'
-        header += '## %s\n' % self.spec.short_spec
-        header += '##\n'
+        header = self.header_format.format(timestamp=timestamp,
+                                           short_spec=self.spec.short_spec)
 
         # TODO : category ?
         # Short description
@@ -578,26 +637,17 @@ class TclModule(EnvModule):
 
     def module_specific_content(self, configuration):
         naming_tokens = self.tokens
+        naming_scheme = self.naming_scheme
         # Conflict
-        conflict_format = configuration.get('conflict', [])
-        f = string.Formatter()
-        for item in conflict_format:
-            line = 'conflict ' + item + '\n'
-            if len([x for x in f.parse(line)
-                    ]) > 1:  # We do have placeholder to substitute
-                for naming_dir, conflict_dir in zip(
-                        self.naming_scheme.split('/'), item.split('/')):
-                    if naming_dir != conflict_dir:
-                        message = 'conflict scheme does not match naming scheme [{spec}]\n\n'  # NOQA: ignore=E501
-                        message += 'naming scheme   : "{nformat}"\n'
-                        message += 'conflict scheme : "{cformat}"\n\n'
-                        message += '** You may want to check your `modules.yaml` configuration file **\n'  # NOQA: ignore=E501
-                        tty.error(message.format(spec=self.spec,
-                                                 nformat=self.naming_scheme,
-                                                 cformat=item))
-                        raise SystemExit('Module generation aborted.')
-                line = line.format(**naming_tokens)
-            yield line
+        for item in configuration.get('conflict', []):
+            # We do have placeholder to substitute
+            if _has_format_fields(item):
+                if _mismatching_path_part(naming_scheme, item) is not None:
+                    tty.error(self.conflict_error_format.format(
+                        spec=self.spec, nformat=naming_scheme, cformat=item))
+                    raise SystemExit('Module generation aborted.')
+                item = item.format(**naming_tokens)
+            yield 'conflict ' + item + '\n'
 
 # To construct an arbitrary hierarchy of module files:
 # 1. Parse the configuration file and check that all the items in
@@ -633,6 +683,16 @@ class LmodModule(EnvModule):
 
     family_format = 'family("{family}")\n'
 
+    header_format = ('-- -*- lua -*-\n'
+                     '-- Module file created by spack (https://github.com/LLNL/spack) on {timestamp}\n'  # NOQA: ignore=E501
+                     '--\n'
+                     '-- {short_spec}\n'
+                     '--\n')
+
+    local_variable_format = (
+        'local {lower}_name = os.getenv("LMOD_{upper}_NAME")\n'
+        'local {lower}_version = os.getenv("LMOD_{upper}_VERSION")\n')
+
     path_part_with_hash = join_path('{token.name}', '{token.version}-{token.hash}')  # NOQA: ignore=E501
     path_part_without_hash = join_path('{token.name}', '{token.version}')
 
@@ -641,6 +701,8 @@ class LmodModule(EnvModule):
     configuration = CONFIGURATION.get('lmod', {})
     hierarchy_tokens = configuration.get('hierarchical_scheme', [])
     hierarchy_tokens = hierarchy_tokens + ['mpi', 'compiler']
+    # Same tokens, for membership tests
+    hierarchy_token_set = frozenset(hierarchy_tokens)
 
     def __init__(self, spec=None):
         super(LmodModule, self).__init__(spec)
@@ -705,7 +767,7 @@ class LmodModule(EnvModule):
         # to distinguish among different variants in a directory hierarchy
         suffixes = self._get_suffixes() if name == '' else []
         # Path part for a provider
-        if name in self.hierarchy_tokens:
+        if name in self.hierarchy_token_set:
             suffixes.append(value.dag_hash(length=7))
 
         value.hash = '-'.join(suffixes)
@@ -733,47 +795,47 @@ class LmodModule(EnvModule):
         available = {}
         available.update(self.requires)
         available.update(self.provides)
-        available_parts = [self.token_to_path(x, available[x])
-                           for x in self.hierarchy_tokens if x in available]
+        available_tokens = [x for x in self.hierarchy_tokens
+                            if x in available]
+        # Path parts of what is available, computed once and reused below
+        available_parts = dict((x, self.token_to_path(x, available[x]))
+                               for x in available_tokens)
         # Missing parts
         missing = [x for x in self.hierarchy_tokens if x not in available]
+        missing_set = frozenset(missing)
         # Direct path we provide on top of compilers
-        modulepath = join_path(self.modules_root, *available_parts)
+        modulepath = join_path(self.modules_root,
+                               *[available_parts[x] for x in available_tokens])
         env = EnvironmentModifications()
         env.prepend_path('MODULEPATH', modulepath)
         for line in self.process_environment_command(env):
             entry += line
 
         def local_variable(x):
-            lower, upper = x.lower(), x.upper()
-            fmt = 'local {lower}_name = os.getenv("LMOD_{upper}_NAME")\n'
-            fmt += 'local {lower}_version = os.getenv("LMOD_{upper}_VERSION")\n'  # NOQA: ignore=501
-            return fmt.format(lower=lower, upper=upper)
+            return self.local_variable_format.format(lower=x.lower(),
+                                                     upper=x.upper())
 
         def set_variables_for_service(env, x):
             upper = x.upper()
-            s = self.provides[x]
-            name, version = os.path.split(self.token_to_path(x, s))
+            name, version = os.path.split(available_parts[x])
 
             env.set('LMOD_{upper}_NAME'.format(upper=upper), name)
             env.set('LMOD_{upper}_VERSION'.format(upper=upper), version)
 
+        # The condition is the same for every conditional modification
+        condition = 'if ' + 'and '.join(
+            '{x}_name '.format(x=x) for x in missing) + 'then\n'
+
         def conditional_modulepath_modifications(item):
-            entry = 'if '
-            needed = []
-            for x in self.hierarchy_tokens:
-                if x in missing:
-                    needed.append('{x}_name '.format(x=x))
-            entry += 'and '.join(needed) + 'then\n'
+            entry = condition
             entry += '  local t = pathJoin("{root}"'.format(
                 root=self.modules_root)
             for x in item:
-                if x in missing:
+                if x in missing_set:
                     entry += ', {lower}_name, {lower}_version'.format(
                         lower=x.lower())
                 else:
-                    entry += ', "{x}"'.format(
-                        x=self.token_to_path(x, available[x]))
+                    entry += ', "{x}"'.format(x=available_parts[x])
             entry += ')\n'
             entry += '  prepend_path("MODULEPATH", t)\n'
             entry += 'end\n\n'
@@ -788,7 +850,7 @@ class LmodModule(EnvModule):
             # Conditional modifications
             conditionals = [x
                             for x in self._hierarchy_to_be_provided()
-                            if any(t in missing for t in x)]
+                            if any(t in missing_set for t in x)]
             for item in conditionals:
                 entry += conditional_modulepath_modifications(item)
 
@@ -806,11 +868,8 @@ class LmodModule(EnvModule):
         timestamp = datetime.datetime.now()
         # Header as in
         # https://www.tacc.utexas.edu/research-development/tacc-projects/lmod/advanced-user-guide/more-about-writing-module-files
-        header = "-- -*- lua -*-\n"
-        header += '-- Module file created by spack (https://github.com/LLNL/spack) on %s\n' % timestamp  # NOQA: ignore=E501
-        header += '--\n'
-        header += '-- %s\n' % self.spec.short_spec
-        header += '--\n'
+        header = self.header_format.format(timestamp=timestamp,
+                                           short_spec=self.spec.short_spec)
 
         # Short description -> whatis()
         if self.short_description:
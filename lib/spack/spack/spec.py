@@ -743,10 +743,12 @@ class Spec(object):
             yaml_text = yaml.dump(
                 self.to_node_dict(), default_flow_style=True, width=sys.maxint)
             sha = hashlib.sha1(yaml_text)
-            b32_hash = base64.b32encode(sha.digest()).lower()[:length]
+            # Always cache the full hash, so that asking for a truncated
+            # one first doesn't force a recomputation later on
+            b32_hash = base64.b32encode(sha.digest()).lower()
             if self.concrete:
                 self._hash = b32_hash
-            return b32_hash
+            return b32_hash[:length]
 
     def to_node_dict(self):
         params = dict((name, v.value) for name, v in self.variants.items())
@@ -22,9 +22,11 @@
 # License along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 ##############################################################################
+import binascii
 import errno
 import os
 import shutil
+import stat
 import tempfile
 
 import llnl.util.lock
@@ -34,11 +36,17 @@ import spack.config
 import spack.error
 import spack.fetch_strategy as fs
 import spack.util.pattern as pattern
-from llnl.util.filesystem import *
+from llnl.util.filesystem import can_access, expand_user, join_path, mkdirp
+from llnl.util.filesystem import remove_linked_tree, touch
+from llnl.util.lang import memoized
+from multiprocessing.pool import ThreadPool
 from urlparse import urljoin
 
 STAGE_PREFIX = 'spack-stage-'
 
+# Maximum number of threads used to remove stage directories in purge()
+PURGE_THREADS = 16
+
 
 class Stage(object):
     """Manages a temporary stage directory for building.
@@ -135,12 +143,11 @@ class Stage(object):
         # used for mirrored archives of repositories
         self.skip_checksum_for_mirror = True
 
-        # TODO : this uses a protected member of tempfile, but seemed the only
-        # TODO : way to get a temporary name besides, the temporary link name
-        # TODO : won't be the same as the temporary stage area in tmp_root
+        # Unnamed stages get a random name. Note that the temporary link
+        # name won't be the same as the temporary stage area in tmp_root
         self.name = name
         if name is None:
-            self.name = STAGE_PREFIX + next(tempfile._get_candidate_names())
+            self.name = STAGE_PREFIX + binascii.hexlify(os.urandom(4))
         self.mirror_path = mirror_path
         self.tmp_root = find_tmp_root()
 
@@ -151,18 +158,36 @@ class Stage(object):
         else:
             self.path = join_path(spack.stage_path, self.name)
 
+        # Archive file names only depend on the mirror path and on the
+        # current fetcher, so compute them once instead of on every access
+        self._mirror_archive_file = None
+        if mirror_path:
+            self._mirror_archive_file = os.path.join(
+                self.path, os.path.basename(mirror_path))
+        self._archive_files_cache = (None, ())
+
         # Flag to decide whether to delete the stage folder on exit or not
         self.keep = keep
-        # File lock for the stage directory
+        # Whether we ever changed the working directory into the stage
+        self._chdir_done = False
+        # File lock for the stage directory. The lock file is created
+        # lazily, so that stages that are never entered don't touch disk
         self._lock_file = None
         self._lock = None
         if lock:
             self._lock_file = join_path(spack.stage_path, self.name + '.lock')
+
+    def _get_lock(self):
+        """Returns the lock for this stage (None if the stage is not locked),
+           creating the lock file on first use.
+        """
+        if self._lock is None and self._lock_file is not None:
             if not os.path.exists(self._lock_file):
                 directory, _ = os.path.split(self._lock_file)
                 mkdirp(directory)
                 touch(self._lock_file)
             self._lock = llnl.util.lock.Lock(self._lock_file)
+        return self._lock
 
     def __enter__(self):
         """
@@ -171,8 +196,9 @@ class Stage(object):
         Returns:
             self
         """
-        if self._lock is not None:
-            self._lock.acquire_write(timeout=60)
+        lock = self._get_lock()
+        if lock is not None:
+            lock.acquire_write(timeout=60)
         self.create()
         return self
 
@@ -198,20 +224,35 @@ class Stage(object):
 
     def _need_to_create_path(self):
         """Makes sure nothing weird has happened since the last time we
-           looked at path.  Returns True if path already exists and is ok.
-           Returns False if path needs to be created.
+           looked at path, removing it if it is a dead link or anything
+           else that can't be used as a stage.  Returns False if path
+           already exists and is ok. Returns True if path needs to be
+           created.
         """
-        # Path doesn't exist yet.  Will need to create it.
-        if not os.path.exists(self.path):
+        # A single lstat tells us whether the path exists and what it is.
+        # Links need an additional stat to check what they point to.
+        try:
+            st = os.lstat(self.path)
+        except OSError:
+            # Path doesn't exist yet.  Will need to create it.
             return True
 
+        is_link = stat.S_ISLNK(st.st_mode)
+        if is_link:
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                # Dead link.  Remove it and start over.
+                os.unlink(self.path)
+                return True
+
         # Path exists but points at something else.  Blow it away.
-        if not os.path.isdir(self.path):
+        if not stat.S_ISDIR(st.st_mode):
             os.unlink(self.path)
             return True
 
         # Path looks ok, but need to check the target of the link.
-        if os.path.islink(self.path):
+        if is_link:
             real_path = os.path.realpath(self.path)
             real_tmp = os.path.realpath(self.tmp_root)
 
@@ -236,35 +277,31 @@ class Stage(object):
 
     @property
     def expected_archive_files(self):
-        """Possible archive file paths."""
-        paths = []
-        if isinstance(self.fetcher, fs.URLFetchStrategy):
-            paths.append(os.path.join(self.path, os.path.basename(
-                self.fetcher.url)))
-
-        if self.mirror_path:
-            paths.append(os.path.join(self.path, os.path.basename(
-                self.mirror_path)))
+        """Possible archive file paths, as a tuple shared between calls."""
+        # The fetcher changes when fetching from mirrors: recompute the
+        # paths only if it did since the last call
+        fetcher, paths = self._archive_files_cache
+        if fetcher is not self.fetcher:
+            paths = []
+            if isinstance(self.fetcher, fs.URLFetchStrategy):
+                paths.append(os.path.join(self.path, os.path.basename(
+                    self.fetcher.url)))
+
+            if self._mirror_archive_file:
+                paths.append(self._mirror_archive_file)
+
+            paths = tuple(paths)
+            self._archive_files_cache = (self.fetcher, paths)
 
         return paths
 
     @property
     def archive_file(self):
         """Path to the source archive within this stage directory."""
-        paths = []
-        if isinstance(self.fetcher, fs.URLFetchStrategy):
-            paths.append(os.path.join(self.path, os.path.basename(
-                self.fetcher.url)))
-
-        if self.mirror_path:
-            paths.append(os.path.join(self.path, os.path.basename(
-                self.mirror_path)))
-
-        for path in paths:
+        for path in self.expected_archive_files:
             if os.path.exists(path):
                 return path
-        else:
-            return None
+        return None
 
     @property
     def source_path(self):
@@ -284,7 +321,8 @@ class Stage(object):
             if not self.fetcher.expand_archive:
                 return self.path
 
-        for p in [os.path.join(self.path, f) for f in os.listdir(self.path)]:
+        for f in os.listdir(self.path):
+            p = os.path.join(self.path, f)
             if os.path.isdir(p):
                 return p
         return None
@@ -295,6 +333,7 @@ class Stage(object):
         """
         if os.path.isdir(self.path):
             os.chdir(self.path)
+            self._chdir_done = True
         else:
             raise ChdirError("Setup failed: no such directory: " + self.path)
 
@@ -311,14 +350,7 @@ class Stage(object):
         # TODO: CompositeFetchStrategy here.
         self.skip_checksum_for_mirror = True
         if self.mirror_path:
-            mirrors = spack.config.get_config('mirrors')
-
-            # Join URLs of mirror roots with mirror paths. Because
-            # urljoin() will strip everything past the final '/' in
-            # the root, so we add a '/' if it is not present.
-            mirror_roots = [root if root.endswith('/') else root + '/'
-                            for root in mirrors.values()]
-            urls = [urljoin(root, self.mirror_path) for root in mirror_roots]
+            mirrors = _get_mirrors()
 
             # If this archive is normally fetched from a tarball URL,
             # then use the same digest.  `spack mirror` ensures that
@@ -331,9 +363,17 @@ class Stage(object):
             # repositories.  How can this be made safer?
             self.skip_checksum_for_mirror = not bool(digest)
 
-            # Add URL strategies for all the mirrors with the digest
-            for url in urls:
-                fetchers.insert(0, fs.URLFetchStrategy(url, digest))
+            # Add URL strategies for all the mirrors with the digest, in
+            # front of the default fetcher and with the last mirror first.
+            # Join URLs of mirror roots with mirror paths. Because
+            # urljoin() will strip everything past the final '/' in
+            # the root, so we add a '/' if it is not present.
+            fetchers[:0] = [
+                fs.URLFetchStrategy(
+                    urljoin(root if root.endswith('/') else root + '/',
+                            self.mirror_path),
+                    digest)
+                for root in reversed(mirrors)]
 
         for fetcher in fetchers:
             try:
@@ -384,6 +424,7 @@ class Stage(object):
             tty.die("Attempt to chdir before expanding archive.")
         else:
             os.chdir(path)
+            self._chdir_done = True
             if not os.listdir(path):
                 tty.die("Archive was empty for %s" % self.name)
 
@@ -409,7 +450,6 @@ class Stage(object):
         # Create the top-level stage directory
         mkdirp(spack.stage_path)
         # FIXME : this breaks concurrency : remove_dead_links(spack.stage_path)
-        remove_if_dead_link(self.path)
         # If a tmp_root exists then create a directory there and then link
         # it in the stage area, otherwise create the stage directory in
         # self.path
@@ -426,11 +466,13 @@ class Stage(object):
         """Removes this stage directory."""
         remove_linked_tree(self.path)
 
-        # Make sure we don't end up in a removed directory
-        try:
-            os.getcwd()
-        except OSError:
-            os.chdir(os.path.dirname(self.path))
+        # Make sure we don't end up in a removed directory. This can only
+        # happen if we changed directory into the stage at some point.
+        if self._chdir_done:
+            try:
+                os.getcwd()
+            except OSError:
+                os.chdir(os.path.dirname(self.path))
 
 
 class ResourceStage(Stage):
@@ -443,16 +485,18 @@ class ResourceStage(Stage):
         super(ResourceStage, self).expand_archive()
         root_stage = self.root_stage
         resource = self.resource
-        placement = os.path.basename(self.source_path)
+        # Both source paths require a scan of the stage directory, so
+        # look them up only once
+        stage_source_path = self.source_path
+        target_path = join_path(root_stage.source_path, resource.destination)
+        placement = os.path.basename(stage_source_path)
         placement = placement if resource.placement is None else resource.placement  # NOQA: ignore=E501
         if not isinstance(placement, dict):
             placement = {'': placement}
         # Make the paths in the dictionary absolute and link
-        for key, value in placement.iteritems():
-            target_path = join_path(root_stage.source_path,
-                                    resource.destination)
-            destination_path = join_path(target_path, value)
-            source_path = join_path(self.source_path, key)
+        for key, value in placement.items():
+            destination_path = os.path.join(target_path, value)
+            source_path = os.path.join(stage_source_path, key)
 
             try:
                 os.makedirs(target_path)
@@ -490,8 +534,9 @@ class StageComposite:
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        keep = getattr(self, 'keep', False)
         for item in reversed(self):
-            item.keep = getattr(self, 'keep', False)
+            item.keep = keep
             item.__exit__(exc_type, exc_val, exc_tb)
 
     #
@@ -557,7 +602,7 @@ class DIYStage(object):
 def _get_mirrors():
     """Get mirrors from spack configuration."""
     config = spack.config.get_config('mirrors')
-    return [val for name, val in config.iteritems()]
+    return list(config.values())
 
 
 def ensure_access(file=spack.stage_path):
@@ -569,14 +614,39 @@ def ensure_access(file=spack.stage_path):
 def purge():
     """Remove all build directories in the top-level stage path."""
     if os.path.isdir(spack.stage_path):
-        for stage_dir in os.listdir(spack.stage_path):
-            stage_path = join_path(spack.stage_path, stage_dir)
-            remove_linked_tree(stage_path)
+        stage_paths = [os.path.join(spack.stage_path, stage_dir)
+                       for stage_dir in os.listdir(spack.stage_path)]
+        if not stage_paths:
+            return
+
+        # Removing trees is bound by filesystem latency rather than by
+        # CPU, so remove the stage directories concurrently.
+        pool = ThreadPool(processes=min(len(stage_paths), PURGE_THREADS))
+        try:
+            pool.map(remove_linked_tree, stage_paths)
+        finally:
+            pool.terminate()
+            pool.join()
 
 
 def find_tmp_root():
-    if spack.use_tmp_stage:
-        for tmp in spack.tmp_dirs:
+    tmp_root = _find_tmp_root(spack.use_tmp_stage, tuple(spack.tmp_dirs))
+    # The cached root may have been removed since it was found.
+    if tmp_root is not None and not os.path.isdir(tmp_root):
+        _find_tmp_root.clear()
+        tmp_root = _find_tmp_root(spack.use_tmp_stage, tuple(spack.tmp_dirs))
+    return tmp_root
+
+
+@memoized
+def _find_tmp_root(use_tmp_stage, tmp_dirs):
+    """Returns the first directory in tmp_dirs that can be created, or None.
+
+       This is called for every stage and touches the filesystem, so the
+       result is cached for each combination of arguments.
+    """
+    if use_tmp_stage:
+        for tmp in tmp_dirs:
             try:
                 # Replace %u with username
                 expanded = expand_user(tmp)
@@ -22,6 +22,7 @@
 # License along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 ##############################################################################
+import copy
 import os
 import shutil
 import tempfile
@@ -29,7 +30,9 @@ import unittest
 
 import spack
 import spack.config
+import spack.util.spack_yaml as syaml
 from llnl.util.filesystem import mkdirp
+from llnl.util.lang import memoized
 from ordereddict_backport import OrderedDict
 from spack.repository import RepoPath
 from spack.spec import Spec
@@ -62,6 +65,18 @@ packages:
       externalvirtual@1.0%gcc@4.5.0: /path/to/external_virtual_gcc
 """
 
+mock_configs = [('compilers', mock_compiler_config),
+                ('packages', mock_packages_config)]
+
+
+@memoized
+def parsed_mock_config(section, text):
+    """Parses and validates a mock configuration section once per run."""
+    data = syaml.load(text)
+    spack.config.validate_section(data, spack.config.section_schemas[section])
+    return data
+
+
 class MockPackagesTest(unittest.TestCase):
     def initmock(self):
         # Use the mock packages database for these tests.  This allows
@@ -79,17 +94,23 @@ class MockPackagesTest(unittest.TestCase):
         self.mock_user_config = os.path.join(self.temp_config, 'user')
         mkdirp(self.mock_site_config)
         mkdirp(self.mock_user_config)
-        for confs in [('compilers.yaml', mock_compiler_config), ('packages.yaml', mock_packages_config)]:
-            conf_yaml = os.path.join(self.mock_site_config, confs[0])
+        for section, text in mock_configs:
+            conf_yaml = os.path.join(self.mock_site_config, section + '.yaml')
             with open(conf_yaml, 'w') as f:
-                f.write(confs[1])
+                f.write(text)
 
         # TODO: Mocking this up is kind of brittle b/c ConfigScope
         # TODO: constructor modifies config_scopes.  Make it cleaner.
         spack.config.config_scopes = OrderedDict()
-        spack.config.ConfigScope('site', self.mock_site_config)
+        site = spack.config.ConfigScope('site', self.mock_site_config)
         spack.config.ConfigScope('user', self.mock_user_config)
 
+        # Don't parse the files just written for every test: start each
+        # one from a copy of the sections parsed the first time around.
+        for section, text in mock_configs:
+            site.sections[section] = copy.deepcopy(
+                parsed_mock_config(section, text))
+
         # Store changes to the package's dependencies so we can
         # restore later.
         self.saved_deps = {}
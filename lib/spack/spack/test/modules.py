@@ -23,6 +23,7 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 ##############################################################################
 import collections
+import re
 from contextlib import contextmanager
 
 import StringIO
@@ -32,6 +33,9 @@ from spack.test.mock_packages_test import MockPackagesTest
 
 FILE_REGISTRY = collections.defaultdict(StringIO.StringIO)
 
+# Concrete specs built so far, keyed on the spec string they come from
+CONCRETE_SPECS = {}
+
 
 # Monkey-patch open to write module files to a StringIO instance
 @contextmanager
@@ -50,9 +54,33 @@ def mock_open(filename, mode):
         handle.close()
 
 
-# Spec strings that will be used throughout the tests
+class ModuleFileContent(list):
+    """Lines of a module file. The whole file is also available as 'text'."""
+
+    def __init__(self, text):
+        super(ModuleFileContent, self).__init__(text.split('\n'))
+        self.text = text
+
+
+def concrete_spec(spec_string):
+    """Returns a concrete spec for spec_string. Concretization is by far the
+    most expensive step of these tests, so each spec string is parsed and
+    concretized only once."""
+    if spec_string not in CONCRETE_SPECS:
+        spec = spack.spec.Spec(spec_string)
+        spec.concretize()
+        CONCRETE_SPECS[spec_string] = spec
+    return CONCRETE_SPECS[spec_string]
+
+
+# Lines of an lmod module file that prepend to CMAKE_PREFIX_PATH
+lmod_prepend_cmake_prefix_path = re.compile(
+    r'^(?:prepend_path|prepend-path)\("CMAKE_PREFIX_PATH"', re.MULTILINE)
+
+# Spec strings that will be used throughout the tests. The mpi provider of
+# mpileaks is fixed, as its concretization is shared among the tests.
 mpich_spec_string = 'mpich@3.0.4 arch=x86-linux'
-mpileaks_spec_string = 'mpileaks arch=x86-linux'
+mpileaks_spec_string = 'mpileaks arch=x86-linux ^mpich2'
 libdwarf_spec_string = 'libdwarf arch=x64-linux'
 
 class HelperFunctionsTests(unittest.TestCase):
@@ -113,12 +141,17 @@ class ModuleFileGeneratorTests(MockPackagesTest):
         spack.modules.CONFIGURATION = self.configuration_instance
         super(ModuleFileGeneratorTests, self).tearDown()
 
-    def get_modulefile_content(self, spec):
-        spec.concretize()
-        generator = self.factory(spec)
+    def patch_configuration(self, name):
+        """
+        Makes the 'configuration_<name>' attribute the current module
+        configuration.
+        """
+        spack.modules.CONFIGURATION = getattr(self, 'configuration_' + name)
+
+    def get_modulefile_content(self, spec_string):
+        generator = self.factory(concrete_spec(spec_string))
         generator.write()
-        content = FILE_REGISTRY[generator.file_name].split('\n')
-        return content
+        return ModuleFileContent(FILE_REGISTRY[generator.file_name])
 
 
 class TclTests(ModuleFileGeneratorTests):
@@ -225,114 +258,88 @@ class TclTests(ModuleFileGeneratorTests):
         }
     }
 
-    def get_modulefile_content(self, spec):
-        spec.concretize()
-        generator = spack.modules.TclModule(spec)
-        generator.write()
-        content = FILE_REGISTRY[generator.file_name].split('\n')
-        return content
-
     def test_simple_case(self):
-        spack.modules.CONFIGURATION = self.configuration_autoload_direct
-        spec = spack.spec.Spec(mpich_spec_string)
-        content = self.get_modulefile_content(spec)
-        self.assertTrue('module-whatis "mpich @3.0.4"' in content)
+        self.patch_configuration('autoload_direct')
+        content = self.get_modulefile_content(mpich_spec_string)
+        self.assertTrue('module-whatis "mpich @3.0.4"' in content.text)
         self.assertRaises(TypeError, spack.modules.dependencies,
-                          spec, 'non-existing-tag')
+                          concrete_spec(mpich_spec_string), 'non-existing-tag')
 
     def test_autoload(self):
-        spack.modules.CONFIGURATION = self.configuration_autoload_direct
-        spec = spack.spec.Spec(mpileaks_spec_string)
-        content = self.get_modulefile_content(spec)
-        self.assertEqual(len([x for x in content if 'is-loaded' in x]), 2)
-        self.assertEqual(len([x for x in content if 'module load ' in x]), 2)
-
-        spack.modules.CONFIGURATION = self.configuration_autoload_all
-        spec = spack.spec.Spec(mpileaks_spec_string)
-        content = self.get_modulefile_content(spec)
-        self.assertEqual(len([x for x in content if 'is-loaded' in x]), 5)
-        self.assertEqual(len([x for x in content if 'module load ' in x]), 5)
+        self.patch_configuration('autoload_direct')
+        content = self.get_modulefile_content(mpileaks_spec_string)
+        self.assertEqual(content.text.count('is-loaded'), 2)
+        self.assertEqual(content.text.count('module load '), 2)
+
+        self.patch_configuration('autoload_all')
+        content = self.get_modulefile_content(mpileaks_spec_string)
+        self.assertEqual(content.text.count('is-loaded'), 5)
+        self.assertEqual(content.text.count('module load '), 5)
 
     def test_prerequisites(self):
-        spack.modules.CONFIGURATION = self.configuration_prerequisites_direct
-        spec = spack.spec.Spec('mpileaks arch=x86-linux')
-        content = self.get_modulefile_content(spec)
-        self.assertEqual(len([x for x in content if 'prereq' in x]), 2)
+        self.patch_configuration('prerequisites_direct')
+        content = self.get_modulefile_content(mpileaks_spec_string)
+        self.assertEqual(content.text.count('prereq'), 2)
 
-        spack.modules.CONFIGURATION = self.configuration_prerequisites_all
-        spec = spack.spec.Spec('mpileaks arch=x86-linux')
-        content = self.get_modulefile_content(spec)
-        self.assertEqual(len([x for x in content if 'prereq' in x]), 5)
+        self.patch_configuration('prerequisites_all')
+        content = self.get_modulefile_content(mpileaks_spec_string)
+        self.assertEqual(content.text.count('prereq'), 5)
 
     def test_alter_environment(self):
-        spack.modules.CONFIGURATION = self.configuration_alter_environment
-        spec = spack.spec.Spec(mpileaks_spec_string)
-        content = self.get_modulefile_content(spec)
+        self.patch_configuration('alter_environment')
+        content = self.get_modulefile_content(mpileaks_spec_string)
         self.assertEqual(
             len([x
                  for x in content
                  if x.startswith('prepend-path CMAKE_PREFIX_PATH')]), 0)
-        self.assertEqual(
-            len([x for x in content if 'setenv FOO "foo"' in x]), 1)
-        self.assertEqual(len([x for x in content if 'unsetenv BAR' in x]), 1)
-        self.assertEqual(
-            len([x for x in content if 'setenv MPILEAKS_ROOT' in x]), 1)
+        self.assertEqual(content.text.count('setenv FOO "foo"'), 1)
+        self.assertEqual(content.text.count('unsetenv BAR'), 1)
+        self.assertEqual(content.text.count('setenv MPILEAKS_ROOT'), 1)
 
-        spec = spack.spec.Spec(libdwarf_spec_string)
-        content = self.get_modulefile_content(spec)
+        content = self.get_modulefile_content(libdwarf_spec_string)
         self.assertEqual(
             len([x
                  for x in content
                  if x.startswith('prepend-path CMAKE_PREFIX_PATH')]), 0)
-        self.assertEqual(
-            len([x for x in content if 'setenv FOO "foo"' in x]), 0)
-        self.assertEqual(len([x for x in content if 'unsetenv BAR' in x]), 0)
-        self.assertEqual(
-            len([x for x in content if 'is-loaded foo/bar' in x]), 1)
-        self.assertEqual(
-            len([x for x in content if 'module load foo/bar' in x]), 1)
-        self.assertEqual(
-            len([x for x in content if 'setenv LIBDWARF_ROOT' in x]), 1)
+        self.assertEqual(content.text.count('setenv FOO "foo"'), 0)
+        self.assertEqual(content.text.count('unsetenv BAR'), 0)
+        self.assertEqual(content.text.count('is-loaded foo/bar'), 1)
+        self.assertEqual(content.text.count('module load foo/bar'), 1)
+        self.assertEqual(content.text.count('setenv LIBDWARF_ROOT'), 1)
 
     def test_blacklist(self):
-        spack.modules.CONFIGURATION = self.configuration_blacklist
-        spec = spack.spec.Spec(mpileaks_spec_string)
-        content = self.get_modulefile_content(spec)
-        print('\n'.join(content))
-        self.assertEqual(len([x for x in content if 'is-loaded' in x]), 1)
-        self.assertEqual(len([x for x in content if 'module load ' in x]), 1)
-        spec = spack.spec.Spec('callpath arch=x86-linux')
+        self.patch_configuration('blacklist')
         # Returns a StringIO instead of a string as no module file was written
-        self.assertRaises(AttributeError, self.get_modulefile_content, spec)
-        spec = spack.spec.Spec('zmpi arch=x86-linux')
-        content = self.get_modulefile_content(spec)
-        print('\n'.join(content))
-        self.assertEqual(len([x for x in content if 'is-loaded' in x]), 1)
-        self.assertEqual(len([x for x in content if 'module load ' in x]), 1)
+        self.assertRaises(AttributeError, self.get_modulefile_content,
+                          'callpath arch=x86-linux')
+        # zmpi is whitelisted, so it is still autoloaded by mpileaks. Both
+        # module files autoload exactly one other module.
+        for spec_string in ('mpileaks arch=x86-linux ^zmpi',
+                            'zmpi arch=x86-linux'):
+            content = self.get_modulefile_content(spec_string)
+            print(content.text)
+            self.assertEqual(content.text.count('is-loaded'), 1)
+            self.assertEqual(content.text.count('module load '), 1)
 
     def test_conflicts(self):
-        spack.modules.CONFIGURATION = self.configuration_conflicts
-        spec = spack.spec.Spec(mpileaks_spec_string)
-        content = self.get_modulefile_content(spec)
+        self.patch_configuration('conflicts')
+        content = self.get_modulefile_content(mpileaks_spec_string)
         self.assertEqual(
             len([x for x in content if x.startswith('conflict')]), 2)
-        self.assertEqual(
-            len([x for x in content if x == 'conflict mpileaks']), 1)
-        self.assertEqual(
-            len([x for x in content if x == 'conflict intel/14.0.1']), 1)
+        self.assertEqual(content.count('conflict mpileaks'), 1)
+        self.assertEqual(content.count('conflict intel/14.0.1'), 1)
 
-        spack.modules.CONFIGURATION = self.configuration_wrong_conflicts
-        self.assertRaises(SystemExit, self.get_modulefile_content, spec)
+        self.patch_configuration('wrong_conflicts')
+        self.assertRaises(SystemExit, self.get_modulefile_content,
+                          mpileaks_spec_string)
 
     def test_suffixes(self):
-        spack.modules.CONFIGURATION = self.configuration_suffix
-        spec = spack.spec.Spec('mpileaks+debug arch=x86-linux')
-        spec.concretize()
+        self.patch_configuration('suffix')
+        spec = concrete_spec('mpileaks+debug arch=x86-linux')
         generator = spack.modules.TclModule(spec)
         self.assertTrue('foo' in generator.use_name)
 
-        spec = spack.spec.Spec('mpileaks~debug arch=x86-linux')
-        spec.concretize()
+        spec = concrete_spec('mpileaks~debug arch=x86-linux')
         generator = spack.modules.TclModule(spec)
         self.assertTrue('bar' in generator.use_name)
 
@@ -361,17 +368,15 @@ class DotkitTests(MockPackagesTest):
         spack.modules.CONFIGURATION = self.configuration_obj
         super(DotkitTests, self).tearDown()
 
-    def get_modulefile_content(self, spec):
-        spec.concretize()
-        generator = spack.modules.Dotkit(spec)
+    def get_modulefile_content(self, spec_string):
+        generator = spack.modules.Dotkit(concrete_spec(spec_string))
         generator.write()
         content = FILE_REGISTRY[generator.file_name].split('\n')
         return content
 
     def test_dotkit(self):
         spack.modules.CONFIGURATION = configuration_dotkit
-        spec = spack.spec.Spec('mpileaks arch=x86-linux')
-        content = self.get_modulefile_content(spec)
+        content = self.get_modulefile_content('mpileaks arch=x86-linux')
         print('\n'.join(content))
         self.assertTrue('#c spack' in content)
         self.assertTrue('#d mpileaks @2.3' in content)
@@ -422,56 +427,41 @@ class LmodTests(ModuleFileGeneratorTests):
     }
 
     def test_simple_case(self):
-        spack.modules.CONFIGURATION = self.configuration_autoload_direct
-        spec = spack.spec.Spec(mpich_spec_string)
-        content = self.get_modulefile_content(spec)
-        self.assertTrue('-- -*- lua -*-' in content)
-        self.assertTrue('whatis([[Name : mpich]])' in content)
-        self.assertTrue('whatis([[Version : 3.0.4]])' in content)
-
-    def test_autoload(self):
-        spack.modules.CONFIGURATION = self.configuration_autoload_direct
-        spec = spack.spec.Spec(mpileaks_spec_string)
-        content = self.get_modulefile_content(spec)
-        self.assertEqual(
-            len([x for x in content if 'if not isloaded(' in x]), 2)
-        self.assertEqual(len([x for x in content if 'load(' in x]), 2)
-
-        spack.modules.CONFIGURATION = self.configuration_autoload_all
-        spec = spack.spec.Spec(mpileaks_spec_string)
-        content = self.get_modulefile_content(spec)
-        self.assertEqual(
-            len([x for x in content if 'if not isloaded(' in x]), 5)
-        self.assertEqual(len([x for x in content if 'load(' in x]), 5)
+        self.patch_configuration('autoload_direct')
+        content = self.get_modulefile_content(mpich_spec_string)
+        self.assertTrue('-- -*- lua -*-' in content.text)
+        self.assertTrue('whatis([[Name : mpich]])' in content.text)
+        self.assertTrue('whatis([[Version : 3.0.4]])' in content.text)
+
+    def test_autoload_variants(self):
+        # Configuration name, expected number of 'if not isloaded(' and of
+        # 'load(' lines in the module file for mpileaks
+        expected = [
+            ('autoload_direct', 2, 2),
+            ('autoload_all', 5, 5),
+            ('blacklist', 1, 1)
+        ]
+        for name, isloaded, load in expected:
+            self.patch_configuration(name)
+            content = self.get_modulefile_content(mpileaks_spec_string)
+            self.assertEqual(
+                content.text.count('if not isloaded('), isloaded, name)
+            self.assertEqual(content.text.count('load('), load, name)
 
     def test_alter_environment(self):
-        spack.modules.CONFIGURATION = self.configuration_alter_environment
-        spec = spack.spec.Spec(mpileaks_spec_string)
-        content = self.get_modulefile_content(spec)
-        self.assertEqual(
-            len([x
-                 for x in content
-                 if x.startswith('prepend_path("CMAKE_PREFIX_PATH"')]), 0)
-        self.assertEqual(
-            len([x for x in content if 'setenv("FOO", "foo")' in x]), 1)
-        self.assertEqual(
-            len([x for x in content if 'unsetenv("BAR")' in x]), 1)
-
-        spec = spack.spec.Spec(libdwarf_spec_string)
-        content = self.get_modulefile_content(spec)
-        self.assertEqual(
-            len([x
-                 for x in content
-                 if x.startswith('prepend-path("CMAKE_PREFIX_PATH"')]), 0)
-        self.assertEqual(
-            len([x for x in content if 'setenv("FOO", "foo")' in x]), 0)
-        self.assertEqual(
-            len([x for x in content if 'unsetenv("BAR")' in x]), 0)
-
-    def test_blacklist(self):
-        spack.modules.CONFIGURATION = self.configuration_blacklist
-        spec = spack.spec.Spec(mpileaks_spec_string)
-        content = self.get_modulefile_content(spec)
-        self.assertEqual(
-            len([x for x in content if 'if not isloaded(' in x]), 1)
-        self.assertEqual(len([x for x in content if 'load(' in x]), 1)
+        # Spec string, expected number of 'setenv("FOO", "foo")' and of
+        # 'unsetenv("BAR")' lines in its module file
+        expected = [
+            (mpileaks_spec_string, 1, 1),
+            (libdwarf_spec_string, 0, 0)
+        ]
+        self.patch_configuration('alter_environment')
+        for spec_string, setenv, unsetenv in expected:
+            content = self.get_modulefile_content(spec_string)
+            self.assertEqual(
+                len(lmod_prepend_cmake_prefix_path.findall(content.text)), 0,
+                spec_string)
+            self.assertEqual(content.text.count('setenv("FOO", "foo")'),
+                             setenv, spec_string)
+            self.assertEqual(
+                content.text.count('unsetenv("BAR")'), unsetenv, spec_string)
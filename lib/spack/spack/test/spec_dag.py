@@ -439,3 +439,15 @@ class SpecDagTest(MockPackagesTest):
         orig_ids = set(id(s) for s in orig.traverse())
         copy_ids = set(id(s) for s in copy.traverse())
         self.assertFalse(orig_ids.intersection(copy_ids))
+
+    def test_dag_hash_truncated_first(self):
+        spec = Spec('mpileaks ^mpich')
+        spec.concretize()
+        short_hash = spec.dag_hash(7)
+
+        # Asking for a truncated hash first must not truncate later ones
+        expected = Spec('mpileaks ^mpich')
+        expected.concretize()
+        self.assertEqual(spec.dag_hash(), expected.dag_hash())
+        self.assertEqual(short_hash, spec.dag_hash()[:7])
+        self.assertEqual(spec.dag_hash(7), spec.dag_hash()[:7])
@@ -31,6 +31,7 @@ import unittest
 from contextlib import *
 
 import spack
+import spack.stage
 from llnl.util.filesystem import *
 from spack.stage import Stage
 from spack.util.executable import which
@@ -312,3 +313,64 @@ class StageTest(unittest.TestCase):
             self.assertTrue(os.path.isdir(path))
         except:
             pass # ignore here.
+
+    def check_setup_over_dead_link(self):
+        """Make sure a dead link at the stage path is replaced on setup."""
+        stage = Stage(archive_url, name=stage_name)
+        os.symlink(join_path(test_files_dir, 'missing'), stage.path)
+        self.assertTrue(os.path.islink(stage.path))
+        self.assertFalse(os.path.exists(stage.path))
+
+        with stage:
+            self.check_setup(stage, stage_name)
+        self.check_destroy(stage, stage_name)
+
+    def test_setup_over_dead_link_with_tmp(self):
+        with use_tmp(True):
+            self.check_setup_over_dead_link()
+
+    def test_setup_over_dead_link_without_tmp(self):
+        with use_tmp(False):
+            self.check_setup_over_dead_link()
+
+    def test_setup_after_tmp_root_removed(self):
+        with use_tmp(True):
+            with Stage(archive_url, name=stage_name) as stage:
+                self.check_setup(stage, stage_name)
+            self.check_destroy(stage, stage_name)
+
+            # The tmp root found for the first stage is gone, so it has
+            # to be created again for the next one.
+            shutil.rmtree(test_tmp_path)
+            with Stage(archive_url, name=stage_name) as stage:
+                self.check_setup(stage, stage_name)
+            self.check_destroy(stage, stage_name)
+
+    def test_purge(self):
+        # Purge a scratch stage path rather than the real one
+        old_stage_path = spack.stage_path
+        spack.stage_path = join_path(test_files_dir, 'purge')
+        try:
+            # Nothing to purge in an empty stage path
+            mkdirp(spack.stage_path)
+            spack.stage.purge()
+            self.assertTrue(os.path.isdir(spack.stage_path))
+            self.assertEqual(os.listdir(spack.stage_path), [])
+
+            targets = []
+            for i in range(3):
+                target = join_path(test_tmp_path, 'linked-stage-%d' % i)
+                mkdirp(join_path(target, archive_dir))
+                os.symlink(target,
+                           join_path(spack.stage_path, 'linked-%d' % i))
+                targets.append(target)
+
+                plain = join_path(spack.stage_path, 'plain-%d' % i)
+                mkdirp(join_path(plain, archive_dir))
+
+            spack.stage.purge()
+            self.assertEqual(os.listdir(spack.stage_path), [])
+            for target in targets:
+                self.assertFalse(os.path.exists(target))
+        finally:
+            spack.stage_path = old_stage_path